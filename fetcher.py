@@ -1,406 +1,689 @@
-#!/usr/bin/env python3
-import os
-import sys
-import argparse
-import logging
-import requests
-import subprocess
-from mp_api.client import MPRester
-from pymatgen.core import Lattice, Structure
-from pymatgen.io.cif import CifWriter
-from pymatgen.io.vasp import Poscar
-from pymatgen.io.pwscf import PWInput
-from dotenv import load_dotenv
-
-logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
-LOG = logging.getLogger("fetcher")
-
-LOCAL_PW_PATH = os.path.join(os.path.dirname(__file__), "third_party", "q-e-qe-7.0", "bin", "pw.x")
-
-
-def _is_offline_error(exc):
-    message = str(exc).lower()
-    offline_signals = [
-        "temporary failure in name resolution",
-        "name or service not known",
-        "failed to resolve",
-        "nodename nor servname provided",
-        "getaddrinfo failed",
-        "connection refused",
-        "network is unreachable",
-        "no route to host",
-    ]
-    if any(signal in message for signal in offline_signals):
-        return True
-    if isinstance(exc, requests.exceptions.RequestException):
-        return True
-    return False
-
-
-def _default_pw_path():
-    env_pw = os.environ.get("QE_PW")
-    if env_pw:
-        return env_pw
-    if os.path.exists(LOCAL_PW_PATH):
-        return LOCAL_PW_PATH
-    return "pw.x"
-
-OPTIMADE_MATERIALS_CLOUD_URLS = [
-    "https://optimade.materialscloud.org/mc3d/optimade/v1",
-    "https://optimade.materialscloud.org/mc3d",
-    "https://optimade.materialscloud.org/optimade/v1",
-]
-
-# UPDATED: Direct download URLs for pseudopotentials
-UPF_BASE_URLS = [
-    "https://pseudopotentials.quantum-espresso.org/upf_files/{}", # Official QE repo
-    "https://raw.githubusercontent.com/pseudo-dojo/pseudo-dojo/main/pseudos/nc-sr-04_pbe_standard/{}", # PseudoDojo (check suffix)
-    "https://raw.githubusercontent.com/dalcorso/pslibrary/master/upf/{}"  # PSLibrary (GitHub)
-]
-
-UPF_SUFFIXES = [
-    ".UPF",
-    ".upf",
-    ".pbe-n-kjpaw_psl.1.0.0.UPF",
-    ".pbe-n-rrkjus_psl.1.0.0.UPF",
-    ".pbe-dn-kjpaw_psl.1.0.0.UPF", 
-    ".pbe-dn-rrkjus_psl.1.0.0.UPF",
-    ".pbe-dnl-kjpaw_psl.1.0.0.UPF",
-    ".pbe-sp-van_ak.UPF",
-    ".pbe-hgh.UPF",
-    "_oncv_psp8.upf"
-]
-
-# Fallback dictionary for common elements (using Official QE Repository)
-KNOWN_UPF_URLS = {
-    "Si": "https://pseudopotentials.quantum-espresso.org/upf_files/Si.pbe-n-rrkjus_psl.1.0.0.UPF",
-    "Ga": "https://pseudopotentials.quantum-espresso.org/upf_files/Ga.pbe-dn-kjpaw_psl.1.0.0.UPF",
-    "N":  "https://pseudopotentials.quantum-espresso.org/upf_files/N.pbe-n-kjpaw_psl.1.0.0.UPF",
-    "Al": "https://pseudopotentials.quantum-espresso.org/upf_files/Al.pbe-n-kjpaw_psl.1.0.0.UPF",
-    "C":  "https://pseudopotentials.quantum-espresso.org/upf_files/C.pbe-n-kjpaw_psl.1.0.0.UPF",
-    "O":  "https://pseudopotentials.quantum-espresso.org/upf_files/O.pbe-n-kjpaw_psl.1.0.0.UPF",
-    "Na": "https://pseudopotentials.quantum-espresso.org/upf_files/Na.pbe-sp-van_ak.UPF",
-    "Zn": "https://pseudopotentials.quantum-espresso.org/upf_files/Zn.pbe-dnl-kjpaw_psl.1.0.0.UPF",
-}
-
-def download_upf(element, output_dir):
-    """Downloads a UPF file for the given element."""
-    # 1. Try known URLs first for reliability
-    if element in KNOWN_UPF_URLS:
-        url = KNOWN_UPF_URLS[element]
-        try:
-            LOG.info(f"Attempting download from known URL for {element}...")
-            response = requests.get(url, timeout=10)
-            if response.status_code == 200:
-                local_filename = os.path.join(output_dir, f"{element}.UPF")
-                with open(local_filename, "wb") as f:
-                    f.write(response.content)
-                LOG.info(f"Successfully downloaded {local_filename} (Standard PBE)")
-                return local_filename
-            else:
-                LOG.warning(f"Known URL failed with status {response.status_code}. Trying generic search...")
-        except requests.RequestException as e:
-            LOG.warning(f"Known URL connection failed: {e}")
-
-    # 2. Generic search
-    for base_url in UPF_BASE_URLS:
-        for suffix in UPF_SUFFIXES:
-            filename_remote = f"{element}{suffix}"
-            url = base_url.format(filename_remote)
-            try:
-                # LOG.info(f"Checking: {url}")
-                response = requests.get(url, timeout=5)
-                if response.status_code == 200:
-                    local_filename = os.path.join(output_dir, f"{element}.UPF")
-                    with open(local_filename, "wb") as f:
-                        f.write(response.content)
-                    LOG.info(f"Successfully downloaded {local_filename} from {url}")
-                    return local_filename
-            except requests.RequestException:
-                continue
-    
-    LOG.error(f"Could not download UPF for element {element} from any checked source. Please download it manually.")
-    return None
-
-def _optimade_entry_to_structure(entry):
-    attributes = entry.get("attributes", {})
-    lattice_vectors = attributes.get("lattice_vectors")
-    cart_positions = attributes.get("cartesian_site_positions")
-    frac_positions = attributes.get("fractional_site_positions")
-    species_at_sites = attributes.get("species_at_sites")
-    species_list = {sp.get("name"): sp for sp in attributes.get("species", [])}
-
-    if not lattice_vectors or not species_at_sites:
-        raise ValueError("OPTIMADE entry missing lattice vectors or species at sites")
-
-    lattice = Lattice(lattice_vectors)
-    if cart_positions:
-        coords = cart_positions
-        coords_are_cartesian = True
-    elif frac_positions:
-        coords = frac_positions
-        coords_are_cartesian = False
-    else:
-        raise ValueError("OPTIMADE entry missing site positions")
-
-    site_species = []
-    for site_name in species_at_sites:
-        species = species_list.get(site_name)
-        if not species:
-            raise ValueError(f"OPTIMADE species definition missing for {site_name}")
-        symbols = species.get("chemical_symbols", [])
-        concentrations = species.get("concentration", [])
-
-        if len(symbols) == 1:
-            site_species.append(symbols[0])
-            continue
-
-        occupancy = {}
-        for symbol, occ in zip(symbols, concentrations):
-            if symbol == "X" or occ <= 0:
-                continue
-            occupancy[symbol] = occ
-        if not occupancy:
-            raise ValueError(f"Invalid occupancy for OPTIMADE species {site_name}")
-        site_species.append(occupancy)
-
-    return Structure(lattice, site_species, coords, coords_are_cartesian=coords_are_cartesian)
-
-
-def _get_structure_from_optimade(formula):
-    try:
-        optimade_filter = f"chemical_formula_reduced=\"{formula}\""
-        data = []
-        last_error = None
-
-        for base_url in OPTIMADE_MATERIALS_CLOUD_URLS:
-            url = f"{base_url.rstrip('/')}/structures"
-            try:
-                response = requests.get(url, params={"filter": optimade_filter, "page_limit": 20}, timeout=10)
-                response.raise_for_status()
-                payload = response.json()
-                data = payload.get("data", [])
-                if data:
-                    break
-            except Exception as exc:
-                last_error = exc
-                continue
-
-        if not data:
-            if last_error:
-                offline_hint = " (offline/connexion)" if _is_offline_error(last_error) else ""
-                LOG.error(
-                    f"No OPTIMADE structures found for formula {formula}. Last error{offline_hint}: {last_error}"
-                )
-            else:
-                LOG.error(f"No OPTIMADE structures found for formula {formula}")
-            return None
-
-        entry = data[0]
-        structure = _optimade_entry_to_structure(entry)
-        entry_id = entry.get("id", "unknown")
-        LOG.info(f"OPTIMADE fallback selected structure {entry_id}")
-        return structure
-    except Exception as e:
-        offline_hint = " (offline/connexion)" if _is_offline_error(e) else ""
-        LOG.error(f"Error communicating with OPTIMADE (Materials Cloud){offline_hint}: {e}")
-        return None
-
-
-def _run_qe_with_runner(input_path, pw_exec, timeout, out_dir, out_name):
-    runner_path = os.path.join(os.path.dirname(__file__), "qe_runner.py")
-    if not os.path.exists(runner_path):
-        LOG.error("qe_runner.py not found at %s", runner_path)
-        return 1
-
-    cmd = [
-        sys.executable,
-        runner_path,
-        str(input_path),
-        "--run_dir",
-        out_dir,
-        "--out",
-        out_name,
-        "--no_timestamp",
-    ]
-    if pw_exec:
-        cmd.extend(["--pw", pw_exec])
-    if timeout:
-        cmd.extend(["--timeout", str(timeout)])
-
-    LOG.info("Running: %s", " ".join(cmd))
-    result = subprocess.run(cmd, check=False)
-    return result.returncode
-
-
-def get_most_stable_structure(api_key, formula):
-    """Fetches the most stable structure for a given formula."""
-    try:
-        with MPRester(api_key) as mpr:
-            # Search for materials with the given formula
-            # UPDATED: Use mpr.materials.summary and correct field energy_above_hull
-            docs = mpr.materials.summary.search(formula=formula, fields=["material_id", "structure", "energy_above_hull", "is_stable"])
-
-            if docs:
-                # Sort by energy above hull (stability)
-                # We want the one closest to 0 (stable)
-                sorted_docs = sorted(docs, key=lambda x: x.energy_above_hull)
-                best_doc = sorted_docs[0]
-
-                LOG.info(f"Found {len(docs)} structures. Selected most stable: {best_doc.material_id} (energy_above_hull={best_doc.energy_above_hull})")
-                return best_doc.structure
-
-            LOG.warning(f"No Materials Project structures found for formula {formula}. Falling back to OPTIMADE.")
-
-    except Exception as e:
-        offline_hint = " (offline/connexion)" if _is_offline_error(e) else ""
-        LOG.error(f"Error communicating with Materials Project{offline_hint}: {e}")
-
-    return _get_structure_from_optimade(formula)
-
-def main():
-    parser = argparse.ArgumentParser(description="Fetch structure and pseudopotentials for a chemical formula.")
-    parser.add_argument("formula", type=str, help="Chemical formula (e.g., Si, GaN)")
-    # Defaults to env var, then to the provided key if env var is missing
-    default_key = os.environ.get("MP_API_KEY", "GBCjLUpcDdcfYKnksM5lF4yVIqD5dtF7")
-    parser.add_argument("--api_key", type=str, default=default_key, help="Materials Project API Key")
-    parser.add_argument("--out_dir", type=str, default=".", help="Output directory")
-    parser.add_argument("--pw", type=str, default=_default_pw_path(), help="pw.x executable or path")
-    parser.add_argument("--timeout", type=int, default=None, help="Timeout in seconds for pw.x")
-    parser.add_argument("--skip_qe", action="store_true", help="Skip running Quantum Espresso")
-
-    args = parser.parse_args()
-
-    if not args.api_key:
-        LOG.error("API Key is required. Set MP_API_KEY env var or pass --api_key.")
-        sys.exit(1)
-
-    if not os.path.exists(args.out_dir):
-        os.makedirs(args.out_dir)
-    
-    # Create pseudopotentials subdirectory
-    upf_dir = os.path.join(args.out_dir, "pseudopotentials")
-    if not os.path.exists(upf_dir):
-        os.makedirs(upf_dir)
-
-    # 1. Fetch Structure
-    structure = get_most_stable_structure(args.api_key, args.formula)
-    if not structure:
-        sys.exit(1)
-
-    # 2. Save Structure
-    # Save as CIF
-    cif_path = os.path.join(args.out_dir, "structure.cif")
-    try:
-        CifWriter(structure).write_file(cif_path)
-        LOG.info(f"Structure saved to {cif_path}")
-    except Exception as e:
-        LOG.error(f"Failed to save CIF: {e}")
-
-    # Save as POSCAR (useful for VASP or conversion tools)
-    poscar_path = os.path.join(args.out_dir, "POSCAR")
-    try:
-        Poscar(structure).write_file(poscar_path)
-        LOG.info(f"Structure saved to {poscar_path}")
-    except Exception as e:
-        LOG.error(f"Failed to save POSCAR: {e}")
-
-    # 3. Download UPFs
-    elements = [str(el) for el in structure.composition.elements]
-    LOG.info(f"Elements in structure: {elements}")
-
-    for el in elements:
-        download_upf(el, upf_dir)
-
-    # 4. Generate QE input file
-    inputs_dir = os.path.join(args.out_dir, "generated_inputs")
-    if not os.path.exists(inputs_dir):
-        os.makedirs(inputs_dir)
-    qe_input_path = os.path.join(inputs_dir, f"{args.formula}.scf.in")
-    try:
-        LOG.info("Generating Quantum Espresso input file...")
-        
-        # Create pseudo dictionary from downloaded files
-        pseudo_dict = {}
-        missing_pseudos = []
-        for el in elements:
-            upf_file = None
-            # Look for the downloaded UPF file
-            for file in os.listdir(upf_dir):
-                if file.startswith(el) and file.endswith('.UPF'):
-                    upf_file = file
-                    break
-            if upf_file:
-                pseudo_dict[el] = upf_file
-            else:
-                missing_pseudos.append(el)
-
-        if missing_pseudos:
-            LOG.error(f"Missing UPF files for: {', '.join(missing_pseudos)}")
-            LOG.error("Download the missing pseudopotentials and rerun.")
-            sys.exit(1)
-        
-        # Set up control parameters
-        control = {
-            'calculation': 'scf',
-            'restart_mode': 'from_scratch',
-            'prefix': args.formula,
-            'pseudo_dir': os.path.abspath(upf_dir),
-            'outdir': os.path.abspath(os.path.join(args.out_dir, 'out')),
-            'verbosity': 'high',
-        }
-        
-        # System parameters
-        system = {
-            'ecutwfc': 50.0,
-            'ecutrho': 200.0,
-            'occupations': 'smearing',
-            'smearing': 'marzari-vanderbilt',
-            'degauss': 0.02,
-        }
-        
-        # Electrons parameters
-        electrons = {
-            'conv_thr': 1.0e-8,
-            'mixing_beta': 0.7,
-        }
-        
-        # Create PWInput
-        pw_input = PWInput(
-            structure=structure,
-            pseudo=pseudo_dict,
-            control=control,
-            system=system,
-            electrons=electrons,
-            kpoints_mode='automatic',
-            kpoints_grid=(4, 4, 4, 1, 1, 1),
-        )
-        
-        # Write to file
-        pw_input.write_file(qe_input_path)
-        LOG.info(f"QE input file saved to {qe_input_path}")
-        
-    except Exception as e:
-        LOG.error(f"Failed to generate QE input file: {e}")
-        import traceback
-        traceback.print_exc()
-        sys.exit(1)
-
-    if args.skip_qe:
-        return
-
-    qe_out_dir = os.path.join(args.out_dir, "out")
-    exit_code = _run_qe_with_runner(
-        input_path=qe_input_path,
-        pw_exec=args.pw,
-        timeout=args.timeout,
-        out_dir=qe_out_dir,
-        out_name=f"{args.formula}.out",
-    )
-
-    if exit_code != 0:
-        sys.exit(exit_code)
-
-if __name__ == "__main__":
-    main()
-
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import asyncio
+import json
+import logging
+import time
+import aiofiles
+import aiohttp
+import requests
+import subprocess
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from mp_api.client import MPRester
+from pymatgen.core import Composition, Lattice, Structure
+from pymatgen.io.cif import CifWriter
+from pymatgen.io.vasp import Poscar
+from pymatgen.io.pwscf import PWInput
+from dotenv import load_dotenv
+from qe_input_generator import _scan_pseudo_dir, find_pseudopotential, render_pw_input
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+LOG = logging.getLogger("fetcher")
+
+LOCAL_PW_PATH = os.path.join(os.path.dirname(__file__), "third_party", "q-e-qe-7.0", "bin", "pw.x")
+
+# Shared session so repeated requests to the same host reuse one TCP+TLS
+# connection instead of paying a handshake per call. Transient server
+# errors retry with exponential backoff inside urllib3 rather than
+# falling through to slower fallback paths.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+    ),
+)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
+
+def _is_offline_error(exc):
+    message = str(exc).lower()
+    offline_signals = [
+        "temporary failure in name resolution",
+        "name or service not known",
+        "failed to resolve",
+        "nodename nor servname provided",
+        "getaddrinfo failed",
+        "connection refused",
+        "network is unreachable",
+        "no route to host",
+    ]
+    if any(signal in message for signal in offline_signals):
+        return True
+    if isinstance(exc, requests.exceptions.RequestException):
+        return True
+    return False
+
+
+def _default_pw_path():
+    env_pw = os.environ.get("QE_PW")
+    if env_pw:
+        return env_pw
+    if os.path.exists(LOCAL_PW_PATH):
+        return LOCAL_PW_PATH
+    return "pw.x"
+
+OPTIMADE_MATERIALS_CLOUD_URLS = [
+    "https://optimade.materialscloud.org/mc3d/optimade/v1",
+    "https://optimade.materialscloud.org/mc3d",
+    "https://optimade.materialscloud.org/optimade/v1",
+]
+
+# UPDATED: Direct download URLs for pseudopotentials
+UPF_BASE_URLS = [
+    "https://pseudopotentials.quantum-espresso.org/upf_files/{}", # Official QE repo
+    "https://raw.githubusercontent.com/pseudo-dojo/pseudo-dojo/main/pseudos/nc-sr-04_pbe_standard/{}", # PseudoDojo (check suffix)
+    "https://raw.githubusercontent.com/dalcorso/pslibrary/master/upf/{}"  # PSLibrary (GitHub)
+]
+
+UPF_SUFFIXES = [
+    ".UPF",
+    ".upf",
+    ".pbe-n-kjpaw_psl.1.0.0.UPF",
+    ".pbe-n-rrkjus_psl.1.0.0.UPF",
+    ".pbe-dn-kjpaw_psl.1.0.0.UPF", 
+    ".pbe-dn-rrkjus_psl.1.0.0.UPF",
+    ".pbe-dnl-kjpaw_psl.1.0.0.UPF",
+    ".pbe-sp-van_ak.UPF",
+    ".pbe-hgh.UPF",
+    "_oncv_psp8.upf"
+]
+
+# Fallback dictionary for common elements (using Official QE Repository)
+KNOWN_UPF_URLS = {
+    "Si": "https://pseudopotentials.quantum-espresso.org/upf_files/Si.pbe-n-rrkjus_psl.1.0.0.UPF",
+    "Ga": "https://pseudopotentials.quantum-espresso.org/upf_files/Ga.pbe-dn-kjpaw_psl.1.0.0.UPF",
+    "N":  "https://pseudopotentials.quantum-espresso.org/upf_files/N.pbe-n-kjpaw_psl.1.0.0.UPF",
+    "Al": "https://pseudopotentials.quantum-espresso.org/upf_files/Al.pbe-n-kjpaw_psl.1.0.0.UPF",
+    "C":  "https://pseudopotentials.quantum-espresso.org/upf_files/C.pbe-n-kjpaw_psl.1.0.0.UPF",
+    "O":  "https://pseudopotentials.quantum-espresso.org/upf_files/O.pbe-n-kjpaw_psl.1.0.0.UPF",
+    "Na": "https://pseudopotentials.quantum-espresso.org/upf_files/Na.pbe-sp-van_ak.UPF",
+    "Zn": "https://pseudopotentials.quantum-espresso.org/upf_files/Zn.pbe-dnl-kjpaw_psl.1.0.0.UPF",
+}
+
+# Index of element -> resolved URL, kept next to the downloaded UPF files so
+# reruns can skip the known-URL / generic sweep entirely.
+UPF_INDEX_NAME = ".upf_index.json"
+
+
+def _load_upf_index(output_dir):
+    index_path = os.path.join(output_dir, UPF_INDEX_NAME)
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_upf_index(output_dir, index):
+    index_path = os.path.join(output_dir, UPF_INDEX_NAME)
+    try:
+        with open(index_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+    except OSError as e:
+        LOG.warning(f"Could not write UPF index {index_path}: {e}")
+
+
+async def _save_upf(response, element, output_dir):
+    """Streams the body of a successful UPF response to <output_dir>/<element>.UPF.
+
+    64 KiB chunks keep RSS flat instead of materializing multi-MB bodies
+    as one bytes object before the write. The stream goes to a .part
+    temp name that is renamed into place only once the body completes,
+    so an interrupted transfer never leaves a truncated <element>.UPF
+    for the warm-path existence checks to trust.
+    """
+    local_filename = os.path.join(output_dir, f"{element}.UPF")
+    partial_filename = f"{local_filename}.part"
+    try:
+        async with aiofiles.open(partial_filename, "wb") as f:
+            async for chunk in response.content.iter_chunked(1 << 16):
+                await f.write(chunk)
+    except BaseException:
+        try:
+            os.remove(partial_filename)
+        except OSError:
+            pass
+        raise
+    os.replace(partial_filename, local_filename)
+    return local_filename
+
+
+async def _probe_upf_url(session, url, timeout):
+    """Checks whether a candidate URL exists without downloading its body.
+
+    Uses HEAD first; servers that reject HEAD get a ranged GET for the
+    first byte. Returns True if the candidate looks downloadable.
+    """
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    try:
+        response = await session.head(url, timeout=client_timeout, allow_redirects=True)
+        response.release()
+        if response.status == 200:
+            return True
+        if response.status in (403, 405, 501):
+            # Server refuses HEAD; retry with a bandwidth-free ranged GET.
+            response = await session.get(
+                url, timeout=client_timeout, headers={"Range": "bytes=0-0"}
+            )
+            response.release()
+            return response.status in (200, 206)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        pass
+    return False
+
+
+async def download_upf(session, element, output_dir, index=None, refresh=False):
+    """Downloads a UPF file for the given element."""
+    index = index if index is not None else {}
+
+    # 0. Skip work that is already on disk, unless a refresh was requested
+    local_filename = os.path.join(output_dir, f"{element}.UPF")
+    if not refresh and os.path.exists(local_filename):
+        LOG.info(f"UPF for {element} already present: {local_filename}")
+        return local_filename
+
+    # 1. Try the URL that worked last time, then known URLs, for reliability
+    direct_urls = []
+    if element in index:
+        direct_urls.append((index[element], "cached URL"))
+    if element in KNOWN_UPF_URLS and KNOWN_UPF_URLS[element] != index.get(element):
+        direct_urls.append((KNOWN_UPF_URLS[element], "known URL"))
+
+    for url, label in direct_urls:
+        LOG.info(f"Attempting download from {label} for {element}...")
+        # Retry transient failures with exponential backoff before giving
+        # up on the fast path and falling through to the generic sweep
+        for attempt in range(3):
+            if attempt:
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+            try:
+                response = await session.get(url, timeout=aiohttp.ClientTimeout(total=10))
+                if response.status == 200:
+                    local_filename = await _save_upf(response, element, output_dir)
+                    index[element] = url
+                    LOG.info(f"Successfully downloaded {local_filename} (Standard PBE)")
+                    return local_filename
+                response.release()
+                if response.status < 500:
+                    # 404 and friends will not improve with retries
+                    LOG.warning(f"{label.capitalize()} failed with status {response.status}. Trying generic search...")
+                    break
+                LOG.warning(f"{label.capitalize()} returned {response.status}; retrying...")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                LOG.warning(f"{label.capitalize()} connection failed: {e}")
+
+    # 2. Generic search: race every candidate URL, first confirmed hit wins
+    candidates = [
+        base_url.format(f"{element}{suffix}")
+        for base_url in UPF_BASE_URLS
+        for suffix in UPF_SUFFIXES
+    ]
+    tasks = {
+        asyncio.create_task(_probe_upf_url(session, url, 5)): url
+        for url in candidates
+    }
+    winner_url = None
+    try:
+        async with asyncio.timeout(15):
+            pending = set(tasks)
+            while pending and winner_url is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result():
+                        winner_url = tasks[task]
+                        break
+    except TimeoutError:
+        LOG.warning(f"UPF discovery for {element} timed out after 15 s")
+    finally:
+        # One stalled candidate must not hold up the run once a hit came back
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    if winner_url:
+        try:
+            response = await session.get(winner_url, timeout=aiohttp.ClientTimeout(total=30))
+            if response.status == 200:
+                local_filename = await _save_upf(response, element, output_dir)
+                index[element] = winner_url
+                LOG.info(f"Successfully downloaded {local_filename} from {winner_url}")
+                return local_filename
+            response.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            LOG.warning(f"Fetch of discovered URL {winner_url} failed: {e}")
+
+    LOG.error(f"Could not download UPF for element {element} from any checked source. Please download it manually.")
+    return None
+
+
+async def download_upfs(elements, output_dir, refresh=False):
+    """Downloads UPF files for all elements concurrently over one pooled session."""
+    index = _load_upf_index(output_dir)
+    connector = aiohttp.TCPConnector(limit=32)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        results = await asyncio.gather(
+            *[download_upf(session, el, output_dir, index, refresh) for el in elements]
+        )
+    _save_upf_index(output_dir, index)
+    return results
+
+def _optimade_entry_to_structure(entry):
+    attributes = entry.get("attributes", {})
+    lattice_vectors = attributes.get("lattice_vectors")
+    cart_positions = attributes.get("cartesian_site_positions")
+    frac_positions = attributes.get("fractional_site_positions")
+    species_at_sites = attributes.get("species_at_sites")
+    species_list = {sp.get("name"): sp for sp in attributes.get("species", [])}
+
+    if not lattice_vectors or not species_at_sites:
+        raise ValueError("OPTIMADE entry missing lattice vectors or species at sites")
+
+    lattice = Lattice(lattice_vectors)
+    if cart_positions:
+        coords = cart_positions
+        coords_are_cartesian = True
+    elif frac_positions:
+        coords = frac_positions
+        coords_are_cartesian = False
+    else:
+        raise ValueError("OPTIMADE entry missing site positions")
+
+    site_species = []
+    for site_name in species_at_sites:
+        species = species_list.get(site_name)
+        if not species:
+            raise ValueError(f"OPTIMADE species definition missing for {site_name}")
+        symbols = species.get("chemical_symbols", [])
+        concentrations = species.get("concentration", [])
+
+        if len(symbols) == 1:
+            site_species.append(symbols[0])
+            continue
+
+        occupancy = {}
+        for symbol, occ in zip(symbols, concentrations):
+            if symbol == "X" or occ <= 0:
+                continue
+            occupancy[symbol] = occ
+        if not occupancy:
+            raise ValueError(f"Invalid occupancy for OPTIMADE species {site_name}")
+        site_species.append(occupancy)
+
+    return Structure(lattice, site_species, coords, coords_are_cartesian=coords_are_cartesian)
+
+
+def _get_structure_from_optimade(formula):
+    try:
+        optimade_filter = f"chemical_formula_reduced=\"{formula}\""
+        data = []
+        last_error = None
+
+        for base_url in OPTIMADE_MATERIALS_CLOUD_URLS:
+            url = f"{base_url.rstrip('/')}/structures"
+            try:
+                response = _SESSION.get(url, params={"filter": optimade_filter, "page_limit": 20}, timeout=10)
+                response.raise_for_status()
+                payload = response.json()
+                data = payload.get("data", [])
+                if data:
+                    break
+            except Exception as exc:
+                last_error = exc
+                continue
+
+        if not data:
+            if last_error:
+                offline_hint = " (offline/connexion)" if _is_offline_error(last_error) else ""
+                LOG.error(
+                    f"No OPTIMADE structures found for formula {formula}. Last error{offline_hint}: {last_error}"
+                )
+            else:
+                LOG.error(f"No OPTIMADE structures found for formula {formula}")
+            return None
+
+        entry = data[0]
+        structure = _optimade_entry_to_structure(entry)
+        entry_id = entry.get("id", "unknown")
+        LOG.info(f"OPTIMADE fallback selected structure {entry_id}")
+        return structure
+    except Exception as e:
+        offline_hint = " (offline/connexion)" if _is_offline_error(e) else ""
+        LOG.error(f"Error communicating with OPTIMADE (Materials Cloud){offline_hint}: {e}")
+        return None
+
+
+def _run_qe_with_runner(input_path, pw_exec, timeout, out_dir, out_name):
+    runner_path = os.path.join(os.path.dirname(__file__), "qe_runner.py")
+    if not os.path.exists(runner_path):
+        LOG.error("qe_runner.py not found at %s", runner_path)
+        return 1
+
+    cmd = [
+        sys.executable,
+        runner_path,
+        str(input_path),
+        "--run_dir",
+        out_dir,
+        "--out",
+        out_name,
+        "--no_timestamp",
+    ]
+    if pw_exec:
+        cmd.extend(["--pw", pw_exec])
+    if timeout:
+        cmd.extend(["--timeout", str(timeout)])
+
+    LOG.info("Running: %s", " ".join(cmd))
+    result = subprocess.run(cmd, check=False)
+    return result.returncode
+
+
+# Resolved structures are deterministic for a formula, so cache them on disk
+# and skip the Materials Project round-trip entirely on reruns.
+STRUCTURE_CACHE_DIR = os.path.expanduser("~/.qe_to_tcad_cache")
+STRUCTURE_CACHE_MAX_AGE = 30 * 86400
+
+
+def _structure_cache_path(formula):
+    return os.path.join(STRUCTURE_CACHE_DIR, f"{formula}.json")
+
+
+def _load_cached_structure(formula):
+    path = _structure_cache_path(formula)
+    try:
+        if time.time() - os.path.getmtime(path) > STRUCTURE_CACHE_MAX_AGE:
+            return None
+        with open(path) as f:
+            return Structure.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _store_cached_structure(formula, structure):
+    try:
+        Path(STRUCTURE_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+        with open(_structure_cache_path(formula), "w") as f:
+            json.dump(structure.as_dict(), f)
+    except (OSError, TypeError) as e:
+        LOG.warning(f"Could not cache structure for {formula}: {e}")
+
+
+def get_most_stable_structures(api_key, formulas, refresh=False):
+    """Fetches the most stable structure for each formula in one batched call."""
+    structures = {}
+
+    if not refresh:
+        for formula in formulas:
+            cached = _load_cached_structure(formula)
+            if cached is not None:
+                LOG.info(f"Using cached structure for {formula} from {STRUCTURE_CACHE_DIR}")
+                structures[formula] = cached
+
+    formulas = [formula for formula in formulas if formula not in structures]
+    if not formulas:
+        return structures
+
+    # Map reduced formulas back to the spelling the caller used
+    reduced_map = {}
+    for formula in formulas:
+        try:
+            reduced_map[Composition(formula).reduced_formula] = formula
+        except Exception:
+            reduced_map[formula] = formula
+
+    try:
+        with MPRester(api_key) as mpr:
+            # One batched query for every formula instead of N round-trips
+            # UPDATED: Use mpr.materials.summary and correct field energy_above_hull
+            docs = mpr.materials.summary.search(
+                formula=list(formulas),
+                fields=["material_id", "structure", "energy_above_hull", "is_stable", "formula_pretty"],
+            )
+
+            grouped = {}
+            for doc in docs:
+                grouped.setdefault(doc.formula_pretty, []).append(doc)
+
+            for reduced, group in grouped.items():
+                formula = reduced_map.get(reduced, reduced)
+                # Lowest energy above hull is the most stable (closest to 0);
+                # a single-pass min avoids sorting the whole polymorph list
+                best_doc = min(group, key=lambda x: x.energy_above_hull)
+
+                LOG.info(f"Found {len(group)} structures for {formula}. Selected most stable: {best_doc.material_id} (energy_above_hull={best_doc.energy_above_hull})")
+                structures[formula] = best_doc.structure
+                _store_cached_structure(formula, best_doc.structure)
+
+    except Exception as e:
+        offline_hint = " (offline/connexion)" if _is_offline_error(e) else ""
+        LOG.error(f"Error communicating with Materials Project{offline_hint}: {e}")
+
+    for formula in formulas:
+        if formula not in structures:
+            LOG.warning(f"No Materials Project structures found for formula {formula}. Falling back to OPTIMADE.")
+            structure = _get_structure_from_optimade(formula)
+            if structure:
+                structures[formula] = structure
+                _store_cached_structure(formula, structure)
+
+    return structures
+
+
+def get_most_stable_structure(api_key, formula, refresh=False):
+    """Fetches the most stable structure for a given formula."""
+    return get_most_stable_structures(api_key, [formula], refresh=refresh).get(formula)
+
+def _process_formula(args, formula, structure, out_dir, upf_dir):
+    """Saves structure files, generates the QE input, and optionally runs pw.x.
+
+    Returns a process-style exit code (0 on success).
+    """
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    # 1. Save Structure
+    # Save as CIF
+    cif_path = os.path.join(out_dir, "structure.cif")
+    try:
+        CifWriter(structure).write_file(cif_path)
+        LOG.info(f"Structure saved to {cif_path}")
+    except Exception as e:
+        LOG.error(f"Failed to save CIF: {e}")
+
+    # Save as POSCAR (useful for VASP or conversion tools)
+    poscar_path = os.path.join(out_dir, "POSCAR")
+    try:
+        Poscar(structure).write_file(poscar_path)
+        LOG.info(f"Structure saved to {poscar_path}")
+    except Exception as e:
+        LOG.error(f"Failed to save POSCAR: {e}")
+
+    elements = [str(el) for el in structure.composition.elements]
+
+    # 2. Generate QE input file
+    inputs_dir = os.path.join(out_dir, "generated_inputs")
+    Path(inputs_dir).mkdir(parents=True, exist_ok=True)
+    qe_input_path = os.path.join(inputs_dir, f"{formula}.scf.in")
+    try:
+        LOG.info("Generating Quantum Espresso input file...")
+
+        # Create pseudo dictionary from downloaded files
+        pseudo_dict = {}
+        missing_pseudos = []
+        for el in elements:
+            # Look for the downloaded UPF file
+            upf_file = find_pseudopotential(el, upf_dir)
+            if upf_file:
+                pseudo_dict[el] = upf_file
+            else:
+                missing_pseudos.append(el)
+
+        if missing_pseudos:
+            LOG.error(f"Missing UPF files for: {', '.join(missing_pseudos)}")
+            LOG.error("Download the missing pseudopotentials and rerun.")
+            return 1
+
+        # Set up control parameters
+        control = {
+            'calculation': 'scf',
+            'restart_mode': 'from_scratch',
+            'prefix': formula,
+            'pseudo_dir': os.path.abspath(upf_dir),
+            'outdir': os.path.abspath(os.path.join(out_dir, 'out')),
+            'verbosity': 'high',
+        }
+
+        # System parameters
+        system = {
+            'ecutwfc': 50.0,
+            'ecutrho': 200.0,
+            'occupations': 'smearing',
+            'smearing': 'marzari-vanderbilt',
+            'degauss': 0.02,
+        }
+
+        # Electrons parameters
+        electrons = {
+            'conv_thr': 1.0e-8,
+            'mixing_beta': 0.7,
+        }
+
+        # Write to file
+        if args.legacy_writer:
+            pw_input = PWInput(
+                structure=structure,
+                pseudo=pseudo_dict,
+                control=control,
+                system=system,
+                electrons=electrons,
+                kpoints_mode='automatic',
+                kpoints_grid=(4, 4, 4, 1, 1, 1),
+            )
+            pw_input.write_file(qe_input_path)
+        else:
+            with open(qe_input_path, "w") as f:
+                f.write(render_pw_input(
+                    structure,
+                    pseudo_dict,
+                    control,
+                    system,
+                    electrons,
+                    kpoints_grid=(4, 4, 4, 1, 1, 1),
+                ))
+        LOG.info(f"QE input file saved to {qe_input_path}")
+
+    except Exception:
+        LOG.exception("Failed to generate QE input file")
+        return 1
+
+    if args.skip_qe:
+        return 0
+
+    qe_out_dir = os.path.join(out_dir, "out")
+    return _run_qe_with_runner(
+        input_path=qe_input_path,
+        pw_exec=args.pw,
+        timeout=args.timeout,
+        out_dir=qe_out_dir,
+        out_name=f"{formula}.out",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetch structure and pseudopotentials for chemical formulas.")
+    parser.add_argument("formula", type=str, nargs="+", help="Chemical formula(s) (e.g., Si, GaN)")
+    # Defaults to env var, then to the provided key if env var is missing
+    default_key = os.environ.get("MP_API_KEY", "GBCjLUpcDdcfYKnksM5lF4yVIqD5dtF7")
+    parser.add_argument("--api_key", type=str, default=default_key, help="Materials Project API Key")
+    parser.add_argument("--out_dir", type=str, default=".", help="Output directory")
+    parser.add_argument("--pw", type=str, default=_default_pw_path(), help="pw.x executable or path")
+    parser.add_argument("--timeout", type=int, default=None, help="Timeout in seconds for pw.x")
+    parser.add_argument("--skip_qe", action="store_true", help="Skip running Quantum Espresso")
+    parser.add_argument("--refresh", action="store_true", help="Re-fetch structures and UPFs even if cached on disk")
+    parser.add_argument("--legacy-writer", action="store_true", help="Emit QE input via pymatgen's PWInput instead of the direct writer")
+
+    args = parser.parse_args()
+    formulas = args.formula
+
+    if not args.api_key:
+        LOG.error("API Key is required. Set MP_API_KEY env var or pass --api_key.")
+        sys.exit(1)
+
+    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+
+    # Create pseudopotentials subdirectory, shared across formulas
+    upf_dir = os.path.join(args.out_dir, "pseudopotentials")
+    Path(upf_dir).mkdir(parents=True, exist_ok=True)
+
+    # 1. Reuse structures already on disk (generate -> edit -> rerun loops),
+    # then fetch the rest over one MPRester session
+    structures = {}
+    if not args.refresh:
+        for formula in formulas:
+            out_dir = args.out_dir if len(formulas) == 1 else os.path.join(args.out_dir, formula)
+            cif_path = os.path.join(out_dir, "structure.cif")
+            if os.path.exists(cif_path):
+                try:
+                    cached_structure = Structure.from_file(cif_path)
+                    # The CIF may be left over from a run for a different
+                    # formula in the same out_dir; only trust it if the
+                    # composition actually matches what was requested
+                    cached_formula = cached_structure.composition.reduced_formula
+                    if cached_formula == Composition(formula).reduced_formula:
+                        structures[formula] = cached_structure
+                        LOG.info(f"Using existing structure from {cif_path}")
+                    else:
+                        LOG.warning(
+                            f"Existing {cif_path} holds {cached_formula}, not {formula}; refetching."
+                        )
+                except Exception as e:
+                    LOG.warning(f"Could not read {cif_path}: {e}")
+
+    remaining = [formula for formula in formulas if formula not in structures]
+    if remaining:
+        structures.update(get_most_stable_structures(args.api_key, remaining, refresh=args.refresh))
+    failures = sum(1 for formula in formulas if formula not in structures)
+    if not structures:
+        sys.exit(1)
+
+    # 2. Download UPFs for the union of elements across all structures;
+    # skip the network phase entirely when everything is already on disk
+    elements = sorted({str(el) for s in structures.values() for el in s.composition.elements})
+    LOG.info(f"Elements across structures: {elements}")
+
+    if args.refresh:
+        missing_elements = elements
+    else:
+        missing_elements = [el for el in elements if find_pseudopotential(el, upf_dir) is None]
+
+    if missing_elements:
+        asyncio.run(download_upfs(missing_elements, upf_dir, refresh=args.refresh))
+        # Downloads invalidate the cached directory snapshot
+        _scan_pseudo_dir.cache_clear()
+        find_pseudopotential.cache_clear()
+    else:
+        LOG.info("All pseudopotentials already present; skipping downloads")
+
+    # 3. Per-formula outputs: flat layout for one formula, subdirs for batches
+    for formula in formulas:
+        structure = structures.get(formula)
+        if structure is None:
+            continue
+        out_dir = args.out_dir if len(formulas) == 1 else os.path.join(args.out_dir, formula)
+        if _process_formula(args, formula, structure, out_dir, upf_dir) != 0:
+            failures += 1
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
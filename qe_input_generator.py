@@ -6,23 +6,31 @@ Converts crystal structures to QE input files (.in) with automatic pseudopotenti
 import os
 import sys
 import argparse
+import functools
 import logging
 from pathlib import Path
-from pymatgen.core import Structure
+from pymatgen.core import Element, Structure
 from pymatgen.io.pwscf import PWInput
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 LOG = logging.getLogger("qe_input_generator")
 
 
+@functools.lru_cache(maxsize=32)
+def _scan_pseudo_dir(pseudo_dir):
+    """Snapshots the filenames in a pseudopotential directory (one scan per dir)."""
+    return tuple(entry.name for entry in Path(pseudo_dir).iterdir())
+
+
+@functools.lru_cache(maxsize=128)
 def find_pseudopotential(element, pseudo_dir="./pseudopotentials"):
     """
     Find the pseudopotential file for a given element.
-    
+
     Args:
         element: Chemical symbol (e.g., 'Si', 'Al')
         pseudo_dir: Directory containing .UPF files
-        
+
     Returns:
         Filename of the pseudopotential or None if not found
     """
@@ -31,36 +39,92 @@ def find_pseudopotential(element, pseudo_dir="./pseudopotentials"):
         LOG.warning(f"Pseudopotential directory {pseudo_dir} does not exist")
         return None
 
-    # Pattern: Element.*.UPF or Element.UPF
-    patterns = [
-        f"{element}.UPF",
-        f"{element}.upf",
-    ]
-    
-    for pattern in patterns:
-        for upf_file in pseudo_path.glob(f"{element}*.UPF"):
-            LOG.info(f"Found pseudopotential for {element}: {upf_file.name}")
-            return upf_file.name
-        for upf_file in pseudo_path.glob(f"{element}*.upf"):
-            LOG.info(f"Found pseudopotential for {element}: {upf_file.name}")
-            return upf_file.name
-    
+    # Pattern: Element*.UPF or Element*.upf, matched against one cached scan
+    for name in _scan_pseudo_dir(str(pseudo_path)):
+        if name.startswith(element) and name.lower().endswith(".upf"):
+            LOG.info(f"Found pseudopotential for {element}: {name}")
+            return name
+
     LOG.warning(f"No pseudopotential found for element {element} in {pseudo_dir}")
     return None
 
 
+@functools.lru_cache(maxsize=128)
 def get_atomic_mass(element):
     """Get atomic mass for common elements (simplified)."""
-    from pymatgen.core import Element
     return Element(element).atomic_mass
 
 
-def generate_qe_input(structure_file, output_file="generated_inputs/pwscf.in", 
+def _fmt_namelist_value(value):
+    if isinstance(value, bool):
+        return ".true." if value else ".false."
+    if isinstance(value, (int, float)):
+        return str(value)
+    return f"'{value}'"
+
+
+def _emit_namelist(name, params):
+    lines = [f"&{name}"]
+    lines.extend(f"  {key} = {_fmt_namelist_value(value)}" for key, value in params.items())
+    lines.append("/")
+    return "\n".join(lines)
+
+
+def render_pw_input(structure, pseudo, control, system, electrons,
+                    ions=None, cell=None, kpoints_grid=(4, 4, 4, 1, 1, 1)):
+    """
+    Render a pw.x input deck directly from the parameter dicts.
+
+    Emits the same namelists and cards as pymatgen's PWInput but with
+    plain string formatting, which keeps batch generation cheap.
+
+    Returns the input file content as a string.
+    """
+    species = [str(el) for el in structure.composition.elements]
+
+    system = dict(system)
+    system.setdefault("ibrav", 0)
+    system["nat"] = len(structure)
+    system["ntyp"] = len(species)
+
+    sections = [
+        _emit_namelist("CONTROL", control),
+        _emit_namelist("SYSTEM", system),
+        _emit_namelist("ELECTRONS", electrons),
+    ]
+    if ions:
+        sections.append(_emit_namelist("IONS", ions))
+    if cell:
+        sections.append(_emit_namelist("CELL", cell))
+
+    species_lines = ["ATOMIC_SPECIES"]
+    for el in species:
+        species_lines.append(f"  {el} {float(get_atomic_mass(el)):.4f} {pseudo[el]}")
+    sections.append("\n".join(species_lines))
+
+    position_lines = ["ATOMIC_POSITIONS crystal"]
+    for site in structure:
+        a, b, c = site.frac_coords
+        position_lines.append(f"  {site.specie.symbol} {a:.8f} {b:.8f} {c:.8f}")
+    sections.append("\n".join(position_lines))
+
+    sections.append("K_POINTS automatic\n  " + " ".join(str(k) for k in kpoints_grid))
+
+    cell_lines = ["CELL_PARAMETERS angstrom"]
+    for row in structure.lattice.matrix:
+        cell_lines.append("  " + " ".join(f"{x:.8f}" for x in row))
+    sections.append("\n".join(cell_lines))
+
+    return "\n".join(sections) + "\n"
+
+
+def generate_qe_input(structure_file, output_file="generated_inputs/pwscf.in",
                       calculation_type="scf", pseudo_dir="./pseudopotentials",
-                      ecutwfc=50.0, ecutrho=None, k_points=(4, 4, 4)):
+                      ecutwfc=50.0, ecutrho=None, k_points=(4, 4, 4),
+                      legacy_writer=False):
     """
     Generate Quantum Espresso input file from crystal structure.
-    
+
     Args:
         structure_file: Path to structure file (CIF, POSCAR, etc.)
         output_file: Output .in file path
@@ -69,7 +133,8 @@ def generate_qe_input(structure_file, output_file="generated_inputs/pwscf.in",
         ecutwfc: Kinetic energy cutoff for wavefunctions (Ry)
         ecutrho: Kinetic energy cutoff for charge density (Ry), defaults to 4*ecutwfc
         k_points: K-points grid (tuple of 3 integers)
-        
+        legacy_writer: Emit via pymatgen's PWInput instead of the direct writer
+
     Returns:
         Path to generated input file
     """
@@ -148,25 +213,35 @@ def generate_qe_input(structure_file, output_file="generated_inputs/pwscf.in",
             'cell_dynamics': 'bfgs',
         }
     
-    # Create PWInput object
+    # Emit the input file
     try:
-        # Build the input dictionary manually for better control
-        pw_input = PWInput(
-            structure=structure,
-            pseudo=pseudo_dict,
-            control=control,
-            system=system,
-            electrons=electrons,
-            ions=ions if ions else None,
-            cell=cell if cell else None,
-            kpoints_mode='automatic',
-            kpoints_grid=k_points + (1, 1, 1),  # Add shifts
-        )
-        
-        # Write to file
         output_path = Path(output_file)
         output_path.parent.mkdir(parents=True, exist_ok=True)
-        pw_input.write_file(str(output_path))
+
+        if legacy_writer:
+            pw_input = PWInput(
+                structure=structure,
+                pseudo=pseudo_dict,
+                control=control,
+                system=system,
+                electrons=electrons,
+                ions=ions if ions else None,
+                cell=cell if cell else None,
+                kpoints_mode='automatic',
+                kpoints_grid=k_points + (1, 1, 1),  # Add shifts
+            )
+            pw_input.write_file(str(output_path))
+        else:
+            output_path.write_text(render_pw_input(
+                structure,
+                pseudo_dict,
+                control,
+                system,
+                electrons,
+                ions=ions if ions else None,
+                cell=cell if cell else None,
+                kpoints_grid=k_points + (1, 1, 1),  # Add shifts
+            ))
         LOG.info(f"Successfully generated QE input file: {output_file}")
         
         # Display summary
@@ -179,10 +254,8 @@ def generate_qe_input(structure_file, output_file="generated_inputs/pwscf.in",
         
         return output_file
         
-    except Exception as e:
-        LOG.error(f"Failed to generate PWInput: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        LOG.exception("Failed to generate QE input")
         return None
 
 
@@ -214,7 +287,9 @@ Examples:
     parser.add_argument("-k", "--kpoints", type=int, nargs=3, default=[4, 4, 4],
                        metavar=('NX', 'NY', 'NZ'),
                        help="K-points grid (default: 4 4 4)")
-    
+    parser.add_argument("--legacy-writer", action="store_true",
+                       help="Emit via pymatgen's PWInput instead of the direct writer")
+
     args = parser.parse_args()
     
     # Check if structure file exists
@@ -230,7 +305,8 @@ Examples:
         pseudo_dir=args.pseudo_dir,
         ecutwfc=args.ecutwfc,
         ecutrho=args.ecutrho,
-        k_points=tuple(args.kpoints)
+        k_points=tuple(args.kpoints),
+        legacy_writer=args.legacy_writer
     )
     
     if result:
@@ -4,14 +4,22 @@ Quantum Espresso runner
 Executes pw.x with basic error detection, logging, and timeout handling.
 """
 import argparse
+import functools
 import logging
+import mmap
 import os
 import re
+import select
 import shutil
-import subprocess
+import signal
 import time
 from pathlib import Path
 
+try:
+    import f90nml
+except ImportError:  # optional; the regex fallback below handles plain inputs
+    f90nml = None
+
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 LOG = logging.getLogger("qe_runner")
 
@@ -29,6 +37,12 @@ SUCCESS_PATTERNS = [
     r"JOB DONE\.",
 ]
 
+# Compiled once at import so detection scans the output twice, not
+# len(ERROR_PATTERNS) + len(SUCCESS_PATTERNS) times. Bytes patterns so
+# they can search an mmap of the output without decoding it.
+_ERROR_RE = re.compile("|".join(f"(?:{p})" for p in ERROR_PATTERNS).encode())
+_SUCCESS_RE = re.compile("|".join(f"(?:{p})" for p in SUCCESS_PATTERNS).encode())
+
 
 def _find_pw_executable(pw_cmd):
     if os.path.isabs(pw_cmd) or "/" in pw_cmd:
@@ -36,26 +50,57 @@ def _find_pw_executable(pw_cmd):
     return shutil.which(pw_cmd)
 
 
-def _parse_namelist_value(text, key):
-    pattern = re.compile(rf"{key}\s*=\s*['\"]?([^,'\"\s]+)", re.IGNORECASE)
-    match = pattern.search(text)
-    return match.group(1) if match else None
+@functools.lru_cache(maxsize=32)
+def _namelist_keys_pattern(keys):
+    return re.compile(rf"\b({'|'.join(keys)})\s*=\s*['\"]?([^,'\"\s]+)", re.IGNORECASE)
+
+
+def _parse_namelist_values(text, keys):
+    """Extracts several namelist keys from the text in a single scan."""
+    values = {}
+    for key, value in _namelist_keys_pattern(keys).findall(text):
+        values.setdefault(key.lower(), value)
+    return values
+
+
+@functools.lru_cache(maxsize=8)
+def _read_control_namelist(path_str, mtime):
+    """Parses the &CONTROL namelist of a QE input once per (path, mtime).
+
+    Prefers f90nml, which tokenizes the file in one pass and handles
+    comments and quoting correctly; falls back to a single regex scan
+    covering all keys of interest.
+    """
+    if f90nml is not None:
+        try:
+            nml = f90nml.read(path_str)
+            return dict(nml.get("control", {}))
+        except Exception as e:
+            LOG.warning("f90nml failed to parse %s (%s); falling back to regex", path_str, e)
+
+    try:
+        content = Path(path_str).read_text()
+    except OSError:
+        return {}
+
+    return _parse_namelist_values(content, ("outdir", "pseudo_dir"))
 
 
 def _ensure_output_dirs(input_path):
     try:
-        content = input_path.read_text()
+        mtime = input_path.stat().st_mtime
     except OSError:
         return
 
-    outdir = _parse_namelist_value(content, "outdir")
+    control = _read_control_namelist(str(input_path), mtime)
+    outdir = control.get("outdir")
     if outdir:
         out_path = Path(outdir)
         if not out_path.is_absolute():
             out_path = input_path.parent / out_path
         out_path.mkdir(parents=True, exist_ok=True)
 
-    pseudo_dir = _parse_namelist_value(content, "pseudo_dir")
+    pseudo_dir = control.get("pseudo_dir")
     if pseudo_dir:
         pseudo_path = Path(pseudo_dir)
         if not pseudo_path.is_absolute():
@@ -65,14 +110,101 @@ def _ensure_output_dirs(input_path):
 
 
 def _detect_qe_errors(output_path):
+    # SCF logs can reach hundreds of MB; scan a read-only mmap instead of
+    # materializing the whole file as a Python string.
     try:
-        content = output_path.read_text(errors="ignore")
+        with open(output_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                has_error = bool(_ERROR_RE.search(mm))
+                # Success markers sit near the end of the file; rfind is a
+                # cheap fast path before the full regex scan.
+                has_success = mm.rfind(b"JOB DONE") != -1 or bool(_SUCCESS_RE.search(mm))
+                return has_error, has_success
+    except ValueError:
+        # Empty output file cannot be mapped
+        return False, False
     except OSError:
         return False, False
 
-    has_error = any(re.search(pat, content) for pat in ERROR_PATTERNS)
-    has_success = any(re.search(pat, content) for pat in SUCCESS_PATTERNS)
-    return has_error, has_success
+
+def _drop_page_cache(path):
+    """Advises the kernel to evict a finished log file from the page cache.
+
+    Large SCF logs are read back exactly once for error detection; keeping
+    hundreds of MB of stdout cached would only push out hotter pages.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _kill_quietly(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def _spawn_and_wait(cmd, cwd, out_f, err_f, timeout):
+    """Spawns cmd via posix_spawnp and waits for it, honoring the timeout.
+
+    posix_spawn skips the fork-time page-table copy of the Python parent;
+    stdout/stderr are wired to the log files with DUP2 file actions. The
+    wait sleeps in the kernel on a pidfd via select instead of polling.
+    Returns the exit code, or 124 on timeout (mirroring timeout(1)).
+    """
+    file_actions = [
+        (os.POSIX_SPAWN_DUP2, out_f.fileno(), 1),
+        (os.POSIX_SPAWN_DUP2, err_f.fileno(), 2),
+    ]
+    # posix_spawn has no cwd parameter; chdir around the spawn instead
+    old_cwd = os.getcwd()
+    os.chdir(cwd)
+    try:
+        pid = os.posix_spawnp(cmd[0], cmd, os.environ, file_actions=file_actions)
+    finally:
+        os.chdir(old_cwd)
+
+    if hasattr(os, "pidfd_open"):
+        pidfd = os.pidfd_open(pid)
+        try:
+            ready, _, _ = select.select([pidfd], [], [], timeout)
+            if not ready:
+                _kill_quietly(pid, signal.SIGTERM)
+                grace, _, _ = select.select([pidfd], [], [], 10)
+                if not grace:
+                    _kill_quietly(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                return 124
+        finally:
+            os.close(pidfd)
+        _, status = os.waitpid(pid, 0)
+        return os.waitstatus_to_exitcode(status)
+
+    # No pidfd support (non-Linux): poll with a short sleep
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        wpid, status = os.waitpid(pid, os.WNOHANG)
+        if wpid:
+            return os.waitstatus_to_exitcode(status)
+        if deadline is not None and time.monotonic() >= deadline:
+            _kill_quietly(pid, signal.SIGTERM)
+            time.sleep(10)
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            if not wpid:
+                _kill_quietly(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            return 124
+        time.sleep(0.2)
 
 
 def run_pw(input_file, pw_exec, output_path, error_path, cwd, timeout, mpi_cmd):
@@ -85,21 +217,15 @@ def run_pw(input_file, pw_exec, output_path, error_path, cwd, timeout, mpi_cmd):
     start_time = time.time()
 
     with open(output_path, "w") as out_f, open(error_path, "w") as err_f:
-        process = subprocess.Popen(cmd, cwd=cwd, stdout=out_f, stderr=err_f)
-        try:
-            process.wait(timeout=timeout)
-        except subprocess.TimeoutExpired:
-            process.terminate()
-            try:
-                process.wait(timeout=10)
-            except subprocess.TimeoutExpired:
-                process.kill()
-            LOG.error("QE run timed out after %s seconds", timeout)
-            return 124
+        returncode = _spawn_and_wait(cmd, cwd, out_f, err_f, timeout)
+
+    if returncode == 124:
+        LOG.error("QE run timed out after %s seconds", timeout)
+        return 124
 
     elapsed = time.time() - start_time
-    LOG.info("QE finished in %.1f s with exit code %s", elapsed, process.returncode)
-    return process.returncode
+    LOG.info("QE finished in %.1f s with exit code %s", elapsed, returncode)
+    return returncode
 
 
 def main():
@@ -148,6 +274,8 @@ def main():
     )
 
     has_error, has_success = _detect_qe_errors(output_path)
+    _drop_page_cache(output_path)
+    _drop_page_cache(error_path)
     if has_error:
         LOG.error("QE output indicates an error. See %s", output_path)
         return 2